@@ -1,6 +1,17 @@
 from collections import namedtuple
+import functools
+import itertools
+import numbers
 import sys
 import math
+import numpy as np
+
+try:
+    import numba
+    prange = numba.prange
+except ImportError:  # numba is optional, pure python tracking still works
+    numba = None
+    prange = range
 
 #--------------------
 # Constants
@@ -14,8 +25,57 @@ pi = math.pi
 
 # Particles
 # Phase space coordinates as def. in Bmad manual section 15.4.2
+# x, px, y, py, z, pz can be scalars (single particle) or 1-D arrays of
+# shape (N,) holding a beam of N particles (struct of arrays).
 Particle = namedtuple('Particle', 'x px y py z pz s p0c mc2')
 
+def _beam_scalar(v, name):
+    """Returns v, which must have the same value for every particle, as
+    a python float.
+    """
+    v = np.asarray(v, dtype=np.float64)
+    if np.any(v != v.flat[0]):
+        raise ValueError(f"{name} must be the same for every particle")
+    
+    return float(v.flat[0])
+
+class ParticleBatch:
+    """Mutable beam of N particles with the same fields as Particle. The
+    phase space coordinates are copied into contiguous 1-D numpy arrays
+    of type dtype, which the numba tracking routines update in place.
+    With dtype=np.float32 the beam takes half the memory traffic, while
+    the kernels still compute each element in float64 and only round
+    the stored coordinates. s, p0c and mc2 are shared by the whole beam
+    and stored as python floats.
+    """
+    def __init__(self, x, px, y, py, z, pz, s, p0c, mc2, dtype=np.float64):
+        coords = np.broadcast_arrays(x, px, y, py, z, pz)
+        self.x, self.px, self.y, self.py, self.z, self.pz = (
+            np.array(c, dtype=dtype).reshape(-1) for c in coords)
+        self.s = _beam_scalar(s, 's')
+        self.p0c = _beam_scalar(p0c, 'p0c')
+        self.mc2 = _beam_scalar(mc2, 'mc2')
+    
+    def to_particle(self, shape=None):
+        """Returns a Particle with a copy of the current state. The
+        coordinates are reshaped to shape if given, and are numpy scalars
+        if shape is ().
+        """
+        shape = self.x.shape if shape is None else shape
+        coords = (c.reshape(shape)[()] if shape == () else
+                  c.reshape(shape).copy()
+                  for c in (self.x, self.px, self.y, self.py, self.z, self.pz))
+        
+        return Particle(*coords, self.s, self.p0c, self.mc2)
+    
+    def update(self, p):
+        """Sets the state of the batch to that of Particle p, e.g. the
+        result of a pure python tracking routine applied to the batch.
+        """
+        for name in ('x', 'px', 'y', 'py', 'z', 'pz'):
+            getattr(self, name)[...] = getattr(p, name)
+        self.s = _beam_scalar(p.s, 's')
+
 # Elements
 Drift = namedtuple('Drift', 'L')
 Quadrupole = namedtuple('Quadrupole', 
@@ -25,10 +85,32 @@ CrabCavity = namedtuple('CrabCavity',
                         'L VOLTAGE PHI0 RF_FREQUENCY X_OFFSET Y_OFFSET, TILT',
                         defaults=(None, None, 1, 0, 0, 0))
 
+# Compiled lattice (see compile_lattice)
+# op_codes -- int8 array with the element type of each element
+# params -- float64 array of shape (n_elements, 6) with the parameters
+#           L, K1, NUM_STEPS, X_OFFSET, Y_OFFSET, TILT of each element
+#           (NUM_STEPS is kept for reference, see track_a_quadrupole)
+CompiledLattice = namedtuple('CompiledLattice', 'op_codes params')
+DRIFT_OP = 0
+QUADRUPOLE_OP = 1
+
+# Maximum number of particles tracked through the whole compiled lattice
+# before moving on to the next ones: the 6 float64 coordinate arrays of a
+# block (192 kB) stay in L2 cache from one element to the next.
+BLOCK_SIZE = 4096
+
 #--------------------
 # AUXILIARY FUNCTIONS
 #--------------------
 
+def _is_zero(v):
+    """True if the element parameter v is zero and no gradient with
+    respect to it is needed, so the transformation it enters can be
+    skipped.
+    """
+    return (not getattr(v, 'requires_grad', False)
+            and getattr(v, 'ndim', 0) == 0 and v == 0)
+
 def make_f(lib, f):
     """Makes function f using library lib."""
     sqrt = lib.sqrt
@@ -36,7 +118,20 @@ def make_f(lib, f):
     cos = lib.cos
     sinh = lib.sinh
     cosh = lib.cosh
+    sinc = lib.sinc
     absolute = lib.abs
+    all_ = lib.all
+    any_ = lib.any
+    empty_like = lib.empty_like
+    broadcast_to = lib.broadcast_to
+    
+    def subset(v, mask):
+        """Values of v, broadcast to the shape of mask, for the particles
+        selected by mask. Scalars are returned as is.
+        """
+        if getattr(v, 'ndim', 0) == 0:
+            return v
+        return broadcast_to(v, mask.shape)[mask]
     
     def sqrt_one(x):
         """Routine to calculate Sqrt[1+x] - 1 to machine precision."""
@@ -48,6 +143,8 @@ def make_f(lib, f):
     def quad_mat2_calc(k1, length, rel_p):
         """Returns 2x2 transfer matrix elements aij and the
         coefficients to calculate the change in z position.
+        k1 and rel_p can be arrays, in which case every output is an
+        array holding the coefficients of each particle.
         Input: 
             k1_ref -- Quad strength: k1 > 0 ==> defocus
             length -- Quad length
@@ -56,26 +153,57 @@ def make_f(lib, f):
             a11, a12, a21, a22 -- transfer matrix elements
             c1, c2, c3 -- second order derivatives of z such that 
                         z = c1 * x_0^2 + c2 * x_0 * px_0 + c3* px_0^2
-        **NOTE**: accumulated error due to machine epsilon. REVISIT
         """ 
-        eps = 2.220446049250313e-16  # machine epsilon to double precission
+        kl2 = k1 * length * length
         
-        sqrt_k = sqrt(absolute(k1)+eps)
-        sk_l = sqrt_k * length
+        def taylor(kl2, length):
+            # sk_l < 1e-4: Taylor series, valid for both signs of k1
+            # (and differentiable at k1 = 0, unlike sqrt(|k1|))
+            kl4 = kl2 * kl2
+            return 1 + kl2/2 + kl4/24, length * (1 + kl2/6 + kl4/120)
         
-        cx = cos(sk_l) * (k1<=0) + cosh(sk_l) * (k1>0) 
-        sx = (sin(sk_l)/(sqrt_k))*(k1<=0) + (sinh(sk_l)/(sqrt_k))*(k1>0)
+        # sx = sin(sk_l)/sqrt_k is written as length*sinc (and its
+        # hyperbolic analog) to avoid the cancellation as k1 -> 0.
+        def hyperbolic(k1, length):
+            sk_l = sqrt(k1) * length
+            return cosh(sk_l), length * sinh(sk_l) / sk_l
+        
+        def trigonometric(k1, length):
+            sk_l = sqrt(-k1) * length
+            return cos(sk_l), length * sinc(sk_l/pi)
+        
+        # k1 has the sign of the element strength for every particle,
+        # so only one pair of transcendentals is usually evaluated.
+        small = absolute(kl2) < 1e-8
+        if all_(small):
+            cx, sx = taylor(kl2, length)
+        elif not any_(small) and all_(k1 > 0):
+            cx, sx = hyperbolic(k1, length)
+        elif not any_(small) and all_(k1 < 0):
+            cx, sx = trigonometric(k1, length)
+        else:
+            # each form on its own particles, e.g. a K1 scan through 0
+            hyp = ~small & (k1 > 0)
+            trig = ~(small | hyp)  # k1 < 0 (or NaN for lost particles)
+            cx = empty_like(kl2)
+            sx = empty_like(kl2)
+            cx[small], sx[small] = taylor(kl2[small], subset(length, small))
+            cx[hyp], sx[hyp] = hyperbolic(subset(k1, hyp),
+                                          subset(length, hyp))
+            cx[trig], sx[trig] = trigonometric(subset(k1, trig),
+                                               subset(length, trig))
           
         a11 = cx
         a12 = sx / rel_p
         a21 = k1 * sx * rel_p
         a22 = cx
             
-        c1 = k1 * (-cx * sx + length) / 4
-        c2 = -k1 * sx**2 / (2 * rel_p)
-        c3 = -(cx * sx + length) / (4 * rel_p**2)
+        cxsx = cx * sx
+        c1 = k1 * (-cxsx + length) / 4
+        c2 = -k1 * sx * sx / (2 * rel_p)
+        c3 = -(cxsx + length) / (4 * rel_p * rel_p)
 
-        return [[a11, a12], [a21, a22]], [c1, c2, c3]
+        return a11, a12, a21, a22, c1, c2, c3
     
     def low_energy_z_correction(pz, p0c, mass, ds):
         """Corrects the change in z-coordinate due to speed < c_light.
@@ -85,35 +213,63 @@ def make_f(lib, f):
         Output: 
             dz -- dz=(ds-d_particle) + ds*(beta - beta_ref)/beta_ref
         """
-        beta = (1+pz) * p0c / sqrt(((1+pz)*p0c)**2 + mass**2)
-        beta0 = p0c / sqrt( p0c**2 + mass**2)
-        e_tot = sqrt(p0c**2+mass**2)
-        
-        evaluation = mass * (beta0*pz)**2
-        dz = (ds * pz * (1 - 3*(pz*beta0**2)/2+pz**2*beta0**2
-                         * (2*beta0**2-(mass/e_tot)**2/2) )
-              * (mass/e_tot)**2
-              * (evaluation<3e-7*e_tot)
-              + (ds*(beta-beta0)/beta0)
-              * (evaluation>=3e-7*e_tot) )
+        def taylor(pz, p0c, mass, ds):
+            mass2 = mass * mass
+            p0c2 = p0c * p0c
+            e_tot2 = p0c2 + mass2
+            beta0_2 = p0c2 / e_tot2
+            mass_e_tot2 = mass2 / e_tot2  # (mass/e_tot)**2
+            return (ds * pz * (1 - 3*(pz*beta0_2)/2+pz*pz*beta0_2
+                               * (2*beta0_2-mass_e_tot2/2) )
+                    * mass_e_tot2)
+        
+        def direct(pz, p0c, mass, ds):
+            mass2 = mass * mass
+            beta0 = p0c / sqrt(p0c*p0c + mass2)
+            pc = (1+pz) * p0c
+            beta = pc / sqrt(pc*pc + mass2)
+            return ds*(beta-beta0)/beta0
+        
+        # Usually every particle is in the same regime (Taylor series
+        # for relativistic beams), so only one branch is evaluated.
+        mass2 = mass * mass
+        p0c2 = p0c * p0c
+        e_tot2 = p0c2 + mass2
+        taylor_ok = mass * p0c2 / e_tot2 * pz * pz < 3e-7*sqrt(e_tot2)
+        if all_(taylor_ok):
+            return taylor(pz, p0c, mass, ds)
+        if not any_(taylor_ok):
+            return direct(pz, p0c, mass, ds)
+        
+        # Otherwise each branch is evaluated on its own particles
+        dz = empty_like(ds * pz * p0c * mass)
+        taylor_ok = broadcast_to(taylor_ok, dz.shape)
+        direct_ok = ~taylor_ok
+        
+        dz[taylor_ok] = taylor(*(subset(v, taylor_ok)
+                                 for v in (pz, p0c, mass, ds)))
+        dz[direct_ok] = direct(*(subset(v, direct_ok)
+                                 for v in (pz, p0c, mass, ds)))
         
         return dz
     
     def particle_rf_time(p):
         """Returns rf time of Particle p."""
-        beta = (1+p.pz) * p.p0c / sqrt(((1+p.pz)*p.p0c)**2 + p.mc2**2)
+        pc = (1+p.pz) * p.p0c
+        beta = pc / sqrt(pc*pc + p.mc2*p.mc2)
         time = - p.z / (beta * c_light)
         
         return time
     
-    def offset_particle_entrance(x_offset, y_offset, tilt, p_lab):
+    def offset_particle_entrance(x_offset, y_offset, tilt, p_lab,
+                                 sin_cos=None):
         """transform from the laboratory coordinates to the
-        entrance element coordinates.
+        entrance element coordinates. sin_cos can be given as the
+        precomputed (sin(tilt), cos(tilt)).
         See Bmad sections 5.6.1, 15.3.1 and 24.2
         **NOTE**: transverse only.
         """
-        s = sin(tilt)
-        c = cos(tilt)
+        s, c = (sin(tilt), cos(tilt)) if sin_cos is None else sin_cos
         x_ele_int = p_lab.x - x_offset
         y_ele_int = p_lab.y - y_offset
         x_ele = x_ele_int*c + y_ele_int*s
@@ -126,14 +282,15 @@ def make_f(lib, f):
         
         return p_ele
     
-    def offset_particle_exit(x_offset, y_offset, tilt, p_ele):
+    def offset_particle_exit(x_offset, y_offset, tilt, p_ele,
+                             sin_cos=None):
         """Transforms from the exit element reference frame to the
-        laboratory reference frame.
+        laboratory reference frame. sin_cos can be given as the
+        precomputed (sin(tilt), cos(tilt)).
         See Bmad sections 5.6.1, 15.3.1 and 24.2
         **NOTE**: transverse only as of now.
         """
-        s = sin(tilt)
-        c = cos(tilt)
+        s, c = (sin(tilt), cos(tilt)) if sin_cos is None else sin_cos
         x_lab_int = p_ele.x*c - p_ele.y*s
         y_lab_int = p_ele.x*s + p_ele.y*c
         x_lab = x_lab_int + x_offset
@@ -157,6 +314,270 @@ def make_f(lib, f):
     
     return f_dict[f]
     
+#--------------------
+# NUMBA KERNELS
+#--------------------
+
+# Options of every numba kernel. With the numpy error model, and without
+# the nnan/ninf fastmath flags, a lost particle (e.g. |px| > 1 + pz)
+# gives NaN or inf coordinates as with numpy instead of raising or
+# undefined results, and the rest of the beam is still tracked.
+_NJIT_OPTIONS = dict(cache=True, boundscheck=False, error_model='numpy',
+                     fastmath={'contract', 'arcp', 'reassoc', 'nsz'})
+
+def _njit(**options):
+    """numba.njit with _NJIT_OPTIONS updated by options if numba is
+    installed, identity otherwise.
+    """
+    if numba is None:
+        return lambda f: f
+    return numba.njit(**{**_NJIT_OPTIONS, **options})
+
+@_njit()
+def _sqrt_one(x):
+    """Scalar version of sqrt_one."""
+    return x / (math.sqrt(1 + x) + 1)
+
+@_njit()
+def _drift(x, px, y, py, z, pz, L, p0c, mc2):
+    """Drift tracking of a single particle. Returns the updated x, y, z.
+    """
+    P = 1 + pz
+    Px = px / P
+    Py = py / P
+    Pxy2 = Px*Px + Py*Py
+    Pl = math.sqrt(1-Pxy2)
+    p0cP = p0c * P
+    mc22 = mc2 * mc2
+    
+    x = x + L * Px / Pl
+    y = y + L * Py / Pl
+    z = z + L * (_sqrt_one((mc22 * (2*pz+pz*pz))/(p0cP*p0cP + mc22))
+                 + _sqrt_one(-Pxy2)/Pl)
+    
+    return x, y, z
+
+@_njit()
+def _quad_mat2_calc(k1, length, rel_p):
+    """Scalar version of quad_mat2_calc."""
+    kl2 = k1 * length * length
+    
+    if abs(kl2) < 1e-8:
+        kl4 = kl2 * kl2
+        cx = 1 + kl2/2 + kl4/24
+        sx = length * (1 + kl2/6 + kl4/120)
+    elif k1 > 0:
+        sk_l = math.sqrt(k1) * length
+        cx = math.cosh(sk_l)
+        sx = length * math.sinh(sk_l) / sk_l
+    else:
+        sk_l = math.sqrt(-k1) * length
+        cx = math.cos(sk_l)
+        sx = length * np.sinc(sk_l/pi)
+    
+    a11 = cx
+    a12 = sx / rel_p
+    a21 = k1 * sx * rel_p
+    a22 = cx
+    
+    cxsx = cx * sx
+    c1 = k1 * (-cxsx + length) / 4
+    c2 = -k1 * sx * sx / (2 * rel_p)
+    c3 = -(cxsx + length) / (4 * rel_p * rel_p)
+    
+    return a11, a12, a21, a22, c1, c2, c3
+
+@_njit()
+def _low_energy_z_correction(pz, p0c, mass, ds):
+    """Scalar version of low_energy_z_correction."""
+    mass2 = mass * mass
+    p0c2 = p0c * p0c
+    e_tot2 = p0c2 + mass2
+    e_tot = math.sqrt(e_tot2)
+    beta0_2 = p0c2 / e_tot2
+    mass_e_tot2 = mass2 / e_tot2
+    
+    evaluation = mass * beta0_2 * pz * pz
+    if evaluation < 3e-7*e_tot:
+        return (ds * pz * (1 - 3*(pz*beta0_2)/2+pz*pz*beta0_2
+                           * (2*beta0_2-mass_e_tot2/2) )
+                * mass_e_tot2)
+    else:
+        beta0 = p0c / e_tot
+        pc = (1+pz) * p0c
+        beta = pc / math.sqrt(pc*pc + mass2)
+        return ds*(beta-beta0)/beta0
+
+@_njit()
+def _quad_body(x, px, y, py, z, pz, k1, l, p0c, mc2):
+    """Quadrupole body tracking of a single particle, see
+    track_a_quadrupole. Returns the updated x, px, y, py, z.
+    """
+    rel_p = 1 + pz  # Particle's relative momentum (P/P0)
+    k1 = k1 / rel_p
+    
+    tx11, tx12, tx21, tx22, dz_x1, dz_x2, dz_x3 = _quad_mat2_calc(
+        -k1, l, rel_p)
+    ty11, ty12, ty21, ty22, dz_y1, dz_y2, dz_y3 = _quad_mat2_calc(
+        k1, l, rel_p)
+    
+    z = ( z
+         + dz_x1 * x * x + dz_x2 * x * px + dz_x3 * px * px
+         + dz_y1 * y * y + dz_y2 * y * py + dz_y3 * py * py
+         + _low_energy_z_correction(pz, p0c, mc2, l) )
+    
+    return (tx11 * x + tx12 * px, tx21 * x + tx22 * px,
+            ty11 * y + ty12 * py, ty21 * y + ty22 * py, z)
+
+@_njit()
+def _offset_entrance(x, px, y, py, x_offset, y_offset, s, c):
+    """Scalar version of offset_particle_entrance, taking the sine s and
+    cosine c of the tilt.
+    """
+    x_ele_int = x - x_offset
+    y_ele_int = y - y_offset
+    
+    return (x_ele_int*c + y_ele_int*s, px*c + py*s,
+            -x_ele_int*s + y_ele_int*c, -px*s + py*c)
+
+@_njit()
+def _offset_exit(x, px, y, py, x_offset, y_offset, s, c):
+    """Scalar version of offset_particle_exit, taking the sine s and
+    cosine c of the tilt.
+    """
+    return (x*c - y*s + x_offset, px*c - py*s,
+            x*s + y*c + y_offset, px*s + py*c)
+
+@_njit()
+def _quad(x, px, y, py, z, pz, k1, l, x_off, y_off, aligned, s, c, p0c,
+          mc2):
+    """Quadrupole tracking (offsets, tilt and body) of a single particle.
+    s and c are the sine and cosine of the tilt. Returns the updated x,
+    px, y, py, z.
+    """
+    if not aligned:
+        x, px, y, py = _offset_entrance(x, px, y, py, x_off, y_off, s, c)
+    x, px, y, py, z = _quad_body(x, px, y, py, z, pz, k1, l, p0c, mc2)
+    if not aligned:
+        x, px, y, py = _offset_exit(x, px, y, py, x_off, y_off, s, c)
+    
+    return x, px, y, py, z
+
+@_njit(parallel=True)
+def _track_drift_batch(x, px, y, py, z, pz, x_out, y_out, z_out, L, p0c,
+                       mc2):
+    """Tracks the 1-D coordinate arrays through a drift of length L,
+    writing into the *_out arrays (which can be the input arrays).
+    Coordinates are computed in float64 whatever the array type.
+    Particles are distributed over NUMBA_NUM_THREADS threads.
+    """
+    for j in prange(x.shape[0]):
+        x_out[j], y_out[j], z_out[j] = _drift(
+            np.float64(x[j]), np.float64(px[j]), np.float64(y[j]),
+            np.float64(py[j]), np.float64(z[j]), np.float64(pz[j]),
+            L, p0c, mc2)
+
+@_njit(parallel=True)
+def _track_quad_batch(x, px, y, py, z, pz, x_out, px_out, y_out, py_out,
+                      z_out, l, k1, x_off, y_off, tilt, p0c, mc2):
+    """Tracks the 1-D coordinate arrays through a quadrupole (offsets,
+    tilt and body) in a single pass, writing into the *_out arrays. Each
+    particle is loaded and stored once; the *_out arrays can be the
+    input arrays themselves. Coordinates are computed in float64 (in
+    particular the low energy z correction) whatever the array type,
+    and rounded only when stored. Particles are distributed over
+    NUMBA_NUM_THREADS threads.
+    """
+    aligned = x_off == 0 and y_off == 0 and tilt == 0
+    s = math.sin(tilt)
+    c = math.cos(tilt)
+    
+    for j in prange(x.shape[0]):
+        x_out[j], px_out[j], y_out[j], py_out[j], z_out[j] = _quad(
+            np.float64(x[j]), np.float64(px[j]), np.float64(y[j]),
+            np.float64(py[j]), np.float64(z[j]), np.float64(pz[j]),
+            k1, l, x_off, y_off, aligned, s, c, p0c, mc2)
+
+@_njit(parallel=True)
+def _run_lattice(x, px, y, py, z, pz, p0c, mc2, op_codes, params,
+                 block_size):
+    """Tracks the 1-D coordinate arrays in place through the compiled
+    lattice given by op_codes and params.
+    Particles are tracked by blocks of block_size through the whole
+    lattice, so that a block stays in cache from one element to the
+    next. Blocks are distributed over NUMBA_NUM_THREADS threads.
+    """
+    n = x.shape[0]
+    
+    for b in prange((n + block_size - 1) // block_size):
+        start = b * block_size
+        stop = min(start + block_size, n)
+        for i in range(op_codes.shape[0]):
+            L, k1, _, x_off, y_off, tilt = params[i]
+            if op_codes[i] == DRIFT_OP:
+                for j in range(start, stop):
+                    x[j], y[j], z[j] = _drift(
+                        np.float64(x[j]), np.float64(px[j]),
+                        np.float64(y[j]), np.float64(py[j]),
+                        np.float64(z[j]), np.float64(pz[j]), L, p0c, mc2)
+            else:
+                aligned = x_off == 0 and y_off == 0 and tilt == 0
+                s = math.sin(tilt)
+                c = math.cos(tilt)
+                for j in range(start, stop):
+                    x[j], px[j], y[j], py[j], z[j] = _quad(
+                        np.float64(x[j]), np.float64(px[j]),
+                        np.float64(y[j]), np.float64(py[j]),
+                        np.float64(z[j]), np.float64(pz[j]), k1, L,
+                        x_off, y_off, aligned, s, c, p0c, mc2)
+
+def _block_size(n):
+    """Returns the block size _run_lattice tracks n particles with: at
+    most BLOCK_SIZE, and small enough to give every thread a block.
+    """
+    n_threads = numba.get_num_threads() if numba is not None else 1
+    
+    return max(1, min(BLOCK_SIZE, -(-n // n_threads)))
+
+def _coords_shape(p):
+    """Returns the broadcast shape of the coordinates of Particle p."""
+    return np.broadcast_shapes(*(np.shape(c) for c in p[:6]))
+
+def _coords_dtype(p):
+    """Returns the dtype to store the coordinates of Particle p in: float32
+    if they all are float32, float64 otherwise.
+    """
+    if all(np.asarray(c).dtype == np.float32 for c in p[:6]):
+        return np.float32
+    return np.float64
+
+def _flat_coords(p):
+    """Returns the coordinates of numpy Particle p as contiguous 1-D arrays
+    of a common dtype (see _coords_dtype) that the numba kernels read,
+    and their shape. Coordinates already stored that way are used
+    without copying.
+    """
+    shape = _coords_shape(p)
+    dtype = _coords_dtype(p)
+    flat = [np.ascontiguousarray(c if np.shape(c) == shape
+                                 else np.array(np.broadcast_to(c, shape)),
+                                 dtype=dtype).reshape(-1)
+            for c in p[:6]]
+    
+    return flat, shape
+
+def _unflat(c, shape, c_in=None):
+    """Returns the 1-D array c computed by a numba kernel reshaped to shape
+    (a numpy scalar for shape ()). If c is the flat view of the
+    coordinate c_in, c_in itself is returned when it is an array.
+    """
+    if shape == ():
+        return c[0]
+    if (isinstance(c_in, np.ndarray) and c_in.shape == shape
+        and c_in.dtype == c.dtype):
+        return c_in
+    return c.reshape(shape)
+
 #--------------------
 # TRACKING ROUTINES
 #--------------------
@@ -169,6 +590,8 @@ def make_track_a_drift(lib):
     def track_a_drift(p_in, drift):
         """Tracks the incoming Particle p_in though drift element
         and returns the outgoing particle. 
+        The coordinates of p_in can be arrays, in which case the whole
+        beam is tracked at once (all operations are elementwise).
         See Bmad manual section 24.9 
         """
         L = drift.L
@@ -182,24 +605,65 @@ def make_track_a_drift(lib):
         P = 1 + pz            # Particle's total momentum over p0
         Px = px / P           # Particle's 'x' momentum over p0
         Py = py / P           # Particle's 'y' momentum over p0
-        Pxy2 = Px**2 + Py**2  # Particle's transverse mometum^2 over p0^2
+        Pxy2 = Px*Px + Py*Py  # Particle's transverse mometum^2 over p0^2
         Pl = sqrt(1-Pxy2)     # Particle's longitudinal momentum over p0
+        p0cP = p0c * P        # Particle's total momentum in eV
+        mc22 = mc2 * mc2
         
         x = x + L * Px / Pl
         y = y + L * Py / Pl
         
         # z = z + L * ( beta/beta_ref - 1.0/Pl ) but numerically accurate:
-        dz = L * (sqrt_one((mc2**2 * (2*pz+pz**2))/((p0c*P)**2 + mc2**2))
+        dz = L * (sqrt_one((mc22 * (2*pz+pz*pz))/(p0cP*p0cP + mc22))
                   + sqrt_one(-Pxy2)/Pl)
         z = z + dz
         s = s + L
 
         return Particle(x, px, y, py, z, pz, s, p0c, mc2)
     
+    def track_a_drift_numba(p_in, drift):
+        """Same as track_a_drift, compiled by numba and run in parallel
+        over the particles of the beam. A ParticleBatch p_in is tracked
+        in place and returned. Drifts with an array length are tracked by
+        track_a_drift.
+        """
+        if np.ndim(drift.L) != 0:
+            if isinstance(p_in, ParticleBatch):
+                p_in.update(track_a_drift(p_in, drift))
+                return p_in
+            return track_a_drift(p_in, drift)
+        
+        if isinstance(p_in, ParticleBatch):
+            _track_drift_batch(p_in.x, p_in.px, p_in.y, p_in.py, p_in.z,
+                               p_in.pz, p_in.x, p_in.y, p_in.z,
+                               float(drift.L), p_in.p0c, p_in.mc2)
+            p_in.s = p_in.s + float(drift.L)
+            return p_in
+        
+        if any(np.ndim(v) != 0 for v in (p_in.s, p_in.p0c, p_in.mc2)):
+            return track_a_drift(p_in, drift)
+        
+        # px, py and pz are unchanged, x, y and z are written to new arrays
+        (x, px, y, py, z, pz), shape = _flat_coords(p_in)
+        x_out, y_out, z_out = (np.empty_like(c) for c in (x, y, z))
+        _track_drift_batch(x, px, y, py, z, pz, x_out, y_out, z_out,
+                           float(drift.L), float(p_in.p0c),
+                           float(p_in.mc2))
+        
+        return Particle(_unflat(x_out, shape), _unflat(px, shape, p_in.px),
+                        _unflat(y_out, shape), _unflat(py, shape, p_in.py),
+                        _unflat(z_out, shape), _unflat(pz, shape, p_in.pz),
+                        p_in.s + drift.L, p_in.p0c, p_in.mc2)
+    
+    if lib is np and numba is not None:
+        return track_a_drift_numba
+    
     return track_a_drift
 
 def make_track_a_quadrupole(lib):
     """Makes track_a_quadrupole given the library lib."""
+    sin = lib.sin
+    cos = lib.cos
     quad_mat2_calc = make_f(lib, 'quad_mat2_calc')
     offset_particle_entrance = make_f(lib, 'offset_particle_entrance')
     offset_particle_exit = make_f(lib, 'offset_particle_exit')
@@ -209,54 +673,95 @@ def make_track_a_quadrupole(lib):
         """Tracks the incoming Particle p_in though quad element and
         returns the outgoing particle.
         See Bmad manual section 24.15
+        As pz and k1 are constant through the quad, the map of the whole
+        element is applied at once: the result does not depend on
+        quad.NUM_STEPS (up to rounding errors).
         """
         l = quad.L
         k1 = quad.K1
-        n_step = quad.NUM_STEPS  # number of divisions
-        step_len = l / n_step  # length of division
         
         x_off = quad.X_OFFSET
         y_off = quad.Y_OFFSET
         tilt = quad.TILT
         
-        b1 = k1 * l
-        
         s = p_in.s
         p0c = p_in.p0c
         mc2 = p_in.mc2
         
         # --- TRACKING --- :
         
-        par = offset_particle_entrance(x_off, y_off, tilt, p_in)
+        aligned = _is_zero(x_off) and _is_zero(y_off) and _is_zero(tilt)
+        if aligned:
+            par = p_in
+        else:
+            sin_cos = (sin(tilt), cos(tilt))
+            par = offset_particle_entrance(x_off, y_off, tilt, p_in, sin_cos)
         x, px, y, py, z, pz = par.x, par.px, par.y, par.py, par.z, par.pz
         
-        for i in range(n_step):
-            rel_p = 1 + pz  # Particle's relative momentum (P/P0)
-            k1 = b1/(l*rel_p)
-            
-            tx, dzx = quad_mat2_calc(-k1, step_len, rel_p)
-            ty, dzy = quad_mat2_calc( k1, step_len, rel_p)
-            
-            z = ( z
-                 + dzx[0] * x**2 + dzx[1] * x * px + dzx[2] * px**2
-                 + dzy[0] * y**2 + dzy[1] * y * py + dzy[2] * py**2 )
-            
-            x_next = tx[0][0] * x + tx[0][1] * px
-            px_next = tx[1][0] * x + tx[1][1] * px
-            y_next = ty[0][0] * y + ty[0][1] * py
-            py_next = ty[1][0] * y + ty[1][1] * py
-            
-            x, px, y, py = x_next, px_next, y_next, py_next
-            
-            z = z + low_energy_z_correction(pz, p0c, mc2, step_len)
+        rel_p = 1 + pz  # Particle's relative momentum (P/P0)
+        k1 = k1 / rel_p
+        
+        tx11, tx12, tx21, tx22, dz_x1, dz_x2, dz_x3 = quad_mat2_calc(
+            -k1, l, rel_p)
+        ty11, ty12, ty21, ty22, dz_y1, dz_y2, dz_y3 = quad_mat2_calc(
+            k1, l, rel_p)
+        
+        z = ( z
+             + dz_x1 * x * x + dz_x2 * x * px + dz_x3 * px * px
+             + dz_y1 * y * y + dz_y2 * y * py + dz_y3 * py * py
+             + low_energy_z_correction(pz, p0c, mc2, l) )
+        
+        x, px = tx11 * x + tx12 * px, tx21 * x + tx22 * px
+        y, py = ty11 * y + ty12 * py, ty21 * y + ty22 * py
         
         s = s + l
         
-        par = offset_particle_exit(x_off, y_off, tilt,
-                                   Particle(x, px, y, py, z, pz, s, p0c, mc2))
+        par = Particle(x, px, y, py, z, pz, s, p0c, mc2)
+        if not aligned:
+            par = offset_particle_exit(x_off, y_off, tilt, par, sin_cos)
         
         return par
-      
+    
+    def track_a_quadrupole_numba(p_in, quad):
+        """Same as track_a_quadrupole, with the whole element compiled
+        by numba into a single pass over the beam. A ParticleBatch p_in
+        is tracked in place and returned. Quads with array parameters are
+        tracked by track_a_quadrupole.
+        """
+        if any(np.ndim(v) != 0 for v in quad):
+            if isinstance(p_in, ParticleBatch):
+                p_in.update(track_a_quadrupole(p_in, quad))
+                return p_in
+            return track_a_quadrupole(p_in, quad)
+        
+        if isinstance(p_in, ParticleBatch):
+            _track_quad_batch(p_in.x, p_in.px, p_in.y, p_in.py, p_in.z,
+                              p_in.pz, p_in.x, p_in.px, p_in.y, p_in.py,
+                              p_in.z, float(quad.L), float(quad.K1),
+                              float(quad.X_OFFSET),
+                              float(quad.Y_OFFSET), float(quad.TILT),
+                              p_in.p0c, p_in.mc2)
+            p_in.s = p_in.s + float(quad.L)
+            return p_in
+        
+        if any(np.ndim(v) != 0 for v in (p_in.s, p_in.p0c, p_in.mc2)):
+            return track_a_quadrupole(p_in, quad)
+        
+        # pz is unchanged, the other coordinates are written to new arrays
+        (x, px, y, py, z, pz), shape = _flat_coords(p_in)
+        out = [np.empty_like(c) for c in (x, px, y, py, z)]
+        _track_quad_batch(x, px, y, py, z, pz, *out, float(quad.L),
+                          float(quad.K1), float(quad.X_OFFSET),
+                          float(quad.Y_OFFSET), float(quad.TILT),
+                          float(p_in.p0c), float(p_in.mc2))
+        
+        return Particle(*(_unflat(c, shape) for c in out),
+                        _unflat(pz, shape, p_in.pz),
+                        p_in.s + quad.L, p_in.p0c, p_in.mc2)
+    
+    if lib is np and numba is not None:
+        return track_a_quadrupole_numba
+    
     return track_a_quadrupole
 
 def make_track_a_crab_cavity(lib):
@@ -284,7 +789,12 @@ def make_track_a_crab_cavity(lib):
         y_off = cav.Y_OFFSET
         tilt = cav.TILT
         
-        par = offset_particle_entrance(x_off, y_off, tilt, p_in)
+        aligned = _is_zero(x_off) and _is_zero(y_off) and _is_zero(tilt)
+        if aligned:
+            par = p_in
+        else:
+            sin_cos = (sin(tilt), cos(tilt))
+            par = offset_particle_entrance(x_off, y_off, tilt, p_in, sin_cos)
         
         par = track_this_drift(par, Drift(l/2))
         x, px, y, py, z, pz = par.x, par.px, par.y, par.py, par.z, par.pz
@@ -295,11 +805,13 @@ def make_track_a_crab_cavity(lib):
         
         px = px + voltage * sin(phase)
         
-        beta = (1+pz) * p0c / sqrt(((1+pz)*p0c)**2 + mc2**2)
+        mc22 = mc2 * mc2
+        pc = (1+pz) * p0c
+        beta = pc / sqrt(pc*pc + mc22)
         beta_old = beta
         E_old =  (1+pz) * p0c / beta_old
         E_new = E_old + voltage * cos(phase) * k_rf * x * p0c
-        pc = sqrt(E_new**2-mc2**2)
+        pc = sqrt(E_new*E_new-mc22)
         beta = pc / E_new
         
         pz = (pc - p0c)/p0c        
@@ -308,32 +820,234 @@ def make_track_a_crab_cavity(lib):
         par = track_this_drift(Particle(x, px, y, py, z, pz, s, p0c, mc2),
                                Drift(l/2))
         
-        par = offset_particle_exit(x_off, y_off, tilt, par)
+        if not aligned:
+            par = offset_particle_exit(x_off, y_off, tilt, par, sin_cos)
         
         return par
+    
+    def track_a_crab_cavity_batch(p_in, cav):
+        """Same as track_a_crab_cavity, except that a ParticleBatch p_in
+        is updated in place and returned.
+        """
+        if isinstance(p_in, ParticleBatch):
+            p_in.update(track_a_crab_cavity(p_in, cav))
+            return p_in
+        
+        return track_a_crab_cavity(p_in, cav)
+    
+    if lib is np:
+        return track_a_crab_cavity_batch
         
     return track_a_crab_cavity
 
-def track_a_lattice(p_in,lattice):
-    """Tracks an incomming Particle p_in through lattice and returns a
-    list of outgoing particles after each element.
+def particle_from_coords(coords, s, p0c, mc2):
+    """Returns a Particle whose phase space coordinates are the rows of
+    the (6, N) array coords, each stored as a contiguous 1-D float64 numpy
+    array so that the whole beam is tracked in one vectorized pass.
+    """
+    coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+    x, px, y, py, z, pz = (np.ascontiguousarray(c) for c in coords)
+    
+    return Particle(x, px, y, py, z, pz, s, p0c, mc2)
+
+def compile_lattice(lattice):
+    """Returns lattice as a CompiledLattice that numpy particles are
+    tracked through by a single numba routine, without dispatching
+    on the type of each element in python.
+    **NOTE**: only works with Drifts and Quads with scalar parameters
+    as of now
+    """
+    n = len(lattice)
+    op_codes = np.empty(n, dtype=np.int8)
+    params = np.zeros((n, 6))
+    
+    for i, ele in enumerate(lattice):
+        ele_type = type(ele).__name__
+        if any(np.ndim(v) != 0 for v in ele):
+            raise ValueError(f"Cannot compile {ele_type} elements with "
+                             "array parameters")
+        if ele_type == "Drift":
+            op_codes[i] = DRIFT_OP
+            params[i, 0] = ele.L
+        elif ele_type == "Quadrupole":
+            op_codes[i] = QUADRUPOLE_OP
+            params[i] = ele
+        else:
+            raise ValueError(f"Cannot compile {ele_type} elements")
+    
+    return CompiledLattice(op_codes, params)
+
+def _is_compilable(lattice):
+    """True if lattice only has Drifts and Quads with scalar parameters,
+    see compile_lattice.
     """
-    lib = sys.modules[type(p_in.x).__module__]
-    tracking_function_dict = {
+    return all(type(ele).__name__ in ("Drift", "Quadrupole")
+               and all(np.ndim(v) == 0 for v in ele)
+               for ele in lattice)
+
+def _array_lib(x):
+    """Returns the array library (numpy, torch, cupy...) of x. Python
+    numbers are tracked with numpy.
+    """
+    module = type(x).__module__.split('.')[0]
+    if module == 'builtins':
+        return np
+    return sys.modules[module]
+
+@functools.lru_cache(maxsize=4)
+def _get_trackers(lib):
+    """Returns the dict of tracking functions for library lib, keyed by
+    element type name. Cached so that repeated track_a_lattice calls do
+    not rebuild them.
+    """
+    return {
         "Drift" : make_track_a_drift(lib),
         "Quadrupole" : make_track_a_quadrupole(lib),
         "CrabCavity" : make_track_a_crab_cavity(lib)
     }
+
+def _save_points(n, save):
+    """Returns the number of elements after which the particle is saved
+    when tracking through n elements (see track_a_lattice).
+    """
+    if save is True:
+        return list(range(1, n+1))
+    if save is False:
+        return [n]
+    if save < 1:
+        raise ValueError(f"save must be a bool or a positive int, not {save}")
+    points = list(range(save, n+1, save))
+    if n % save != 0:
+        points.append(n)
+    
+    return points
+
+def _run_key(ele):
+    """Returns the key under which consecutive elements are merged by
+    _merge_runs: the element type and its parameters. Numbers compare by
+    value and anything else (e.g. torch tensors) by identity, so elements
+    are only merged when the gradients through them are unchanged.
+    """
+    return (type(ele).__name__,) + tuple(
+        v if isinstance(v, numbers.Number) else id(v) for v in ele)
+
+def _merge_runs(lattice):
+    """Returns lattice with every run of k identical consecutive Drifts
+    or Quads replaced by one element k times longer, which tracks the
+    same (NUM_STEPS is ignored by the tracking routines and kept as
+    is). The lattice can also be a CompiledLattice.
+    """
+    if isinstance(lattice, CompiledLattice):
+        op_codes, params = lattice
+        n = len(op_codes)
+        if n == 0:
+            return lattice
+        new_run = np.ones(n, dtype=bool)
+        new_run[1:] = ((op_codes[1:] != op_codes[:-1])
+                       | np.any(params[1:] != params[:-1], axis=1))
+        starts = np.flatnonzero(new_run)
+        counts = np.diff(np.append(starts, n))
+        params = params[starts]  # copy
+        params[:, 0] *= counts  # L
+        return CompiledLattice(op_codes[starts], params)
+    
+    merged = []
+    for key, run in itertools.groupby(lattice, key=_run_key):
+        run = list(run)
+        ele = run[0]
+        k = len(run)
+        if k > 1 and key[0] in ("Drift", "Quadrupole"):
+            merged.append(ele._replace(L=k*ele.L))
+        else:
+            merged.extend(run)
+    
+    return merged
+
+def track_a_compiled_lattice(p_in, lattice, save=False):
+    """Tracks an incomming numpy Particle p_in through the CompiledLattice
+    lattice. See track_a_lattice for the meaning of save. If p_in is a
+    ParticleBatch, it is tracked in place and the saved particles are
+    copies of its state.
+    """
+    if isinstance(p_in, ParticleBatch):
+        batch = p_in
+        shape = None
+        all_p = [batch.to_particle()] if save is not False else None
+    else:
+        batch = ParticleBatch(*p_in, dtype=_coords_dtype(p_in))
+        shape = _coords_shape(p_in)
+        all_p = [p_in]
+    if save is False:
+        lattice = _merge_runs(lattice)
+    op_codes, params = lattice
+    block_size = _block_size(batch.x.shape[0])
+    
+    start = 0
+    
+    for stop in _save_points(len(op_codes), save):
+        _run_lattice(batch.x, batch.px, batch.y, batch.py, batch.z,
+                     batch.pz, batch.p0c, batch.mc2,
+                     op_codes[start:stop], params[start:stop], block_size)
+        batch.s = batch.s + float(params[start:stop, 0].sum())
+        if save is not False:
+            all_p.append(batch.to_particle(shape))
+        start = stop
+    
+    if save is not False:
+        return all_p
+    if batch is p_in:
+        return batch
+    
+    return batch.to_particle(shape)
+
+def track_a_lattice(p_in, lattice, save=False, xp=None):
+    """Tracks an incomming Particle p_in through lattice and returns the
+    outgoing particle.
+    If save is True, returns instead a list with p_in and the outgoing
+    particle after each element. If save is an int k, the list holds p_in
+    and the particle after every k-th element (and after the last one).
+    The array library xp (numpy, torch, cupy...) is taken from p_in.x
+    once per call unless given, so a beam stored as arrays (see
+    particle_from_coords) is tracked through each element in a single
+    batched call. A beam of cupy arrays is tracked on the GPU. Numpy
+    particles are tracked through lattices of Drifts and Quads with
+    scalar parameters with track_a_compiled_lattice when numba is
+    installed, and a ParticleBatch p_in is tracked in place (through
+    any lattice, the saved particles are then copies of its state).
+    When only the outgoing particle is returned, runs of identical
+    consecutive Drifts or Quads (as made by stub_lattice) are tracked as
+    a single element.
+    """
+    if isinstance(lattice, CompiledLattice):
+        return track_a_compiled_lattice(p_in, lattice, save)
+    
+    is_batch = isinstance(p_in, ParticleBatch)
+    if is_batch and _is_compilable(lattice):
+        return track_a_compiled_lattice(p_in, compile_lattice(lattice), save)
+    
+    lib = np if is_batch else xp if xp is not None else _array_lib(p_in.x)
+    if (lib is np and numba is not None and not is_batch
+        and all(np.ndim(v) == 0 for v in (p_in.s, p_in.p0c, p_in.mc2))
+        and _is_compilable(lattice)):
+        return track_a_compiled_lattice(p_in, compile_lattice(lattice),
+                                        save)
+    
+    tracking_function_dict = _get_trackers(lib)
+    if save is False:
+        lattice = _merge_runs(lattice)
     n = len(lattice)
-    all_p = [None] * (n+1)
-    all_p[0] = p_in
+    save_points = set(_save_points(n, save))
+    all_p = [p_in.to_particle() if is_batch else p_in]
+    p = p_in
     
     for i in range(n):
         ele = lattice[i]
         track_f = tracking_function_dict[type(ele).__name__]
-        all_p[i+1] = track_f(all_p[i],ele)
+        p = track_f(p, ele)  # a ParticleBatch is tracked in place
+        if i+1 in save_points:
+            all_p.append(p.to_particle() if is_batch else p)
         
-    return all_p
+    return all_p if save is not False else p
 
 
 def stub_element(ele, n):
@@ -349,11 +1063,14 @@ def stub_element(ele, n):
 
 def stub_lattice(lattice, n):
     """Divides every element in the lattice into 'n' elements
-    each and returns divided lattice. 
+    each and returns divided lattice. The lattice can also be a
+    CompiledLattice.
     """
-    stubbed_lattice = []
+    if isinstance(lattice, CompiledLattice):
+        op_codes = np.repeat(lattice.op_codes, n)
+        params = np.repeat(lattice.params, n, axis=0)
+        params[:, 0] /= n
+        return CompiledLattice(op_codes, params)
     
-    for ele in lattice:
-        stubbed_lattice.extend(stub_element(ele, n))
-        
-    return stubbed_lattice
\ No newline at end of file
+    return [short_ele for ele in lattice
+            for short_ele in [ele._replace(L=ele.L/n)] * n]
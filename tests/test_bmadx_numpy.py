@@ -0,0 +1,312 @@
+import pytest
+import numpy as np
+import torch
+from bmadx import track
+
+m_e = 0.510998950e6 #electron mass in eV
+
+class TestBmadxNumpy:
+    
+    # Incoming beam
+    s = 0.0 #initial s
+    p0c = 4.0E+07 #Reference particle momentum in eV
+    mc2 = 1*m_e # electron mass in eV
+    rng = np.random.default_rng(42)
+    coords = rng.normal(scale=1e-3, size=(100, 6)).T
+    lattice = [track.Drift(L=1.0),
+               track.Quadrupole(L=0.1, K1=10.0, NUM_STEPS=2),
+               track.Drift(L=0.5),
+               track.Quadrupole(L=0.1, K1=-5.0, X_OFFSET=1e-3,
+                                Y_OFFSET=-2e-3, TILT=0.3),
+               track.Drift(L=1.0)]
+    
+    def track_one_by_one(self, lattice):
+        """Returns (6, N) array of coordinates obtained by tracking
+        each particle of the beam separately.
+        """
+        out = []
+        for vec in self.coords.T:
+            p_in = track.Particle(*vec, self.s, self.p0c, self.mc2)
+            out.append(track.track_a_lattice(p_in, lattice)[:6])
+        return np.array(out).T
+    
+    def track_torch(self, lattice):
+        """Returns (6, N) array of coordinates obtained by tracking the
+        beam with the pure python tracking routines and torch.
+        """
+        make_track_f = {'Drift': track.make_track_a_drift,
+                        'Quadrupole': track.make_track_a_quadrupole}
+        coords = self.coords
+        for ele in lattice:
+            coords = self.track_torch_ele(
+                make_track_f[type(ele).__name__], ele, coords)
+        return coords
+    
+    def track_torch_ele(self, make_track_f, ele, coords):
+        """Returns (6, N) array of coordinates obtained by tracking coords
+        through ele with make_track_f(torch).
+        """
+        t = lambda v: torch.tensor(v, dtype=torch.double)
+        p_in = track.Particle(*t(coords), t(self.s), t(self.p0c),
+                              t(self.mc2))
+        ele = ele._replace(**{k: t(v) for k, v in ele._asdict().items()
+                              if k != 'NUM_STEPS'})
+        return torch.vstack(make_track_f(torch)(p_in, ele)[:6]).numpy()
+    
+    def test_beam(self):
+        # tracking the beam as arrays equals tracking particle by particle
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        assert all(c.flags.c_contiguous for c in p_in[:6])
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        x_beam = np.vstack(p_out[:6])
+        x_single = self.track_one_by_one(self.lattice)
+        assert np.allclose(x_beam, x_single, atol=0, rtol=1.0e-14)
+    
+    def test_python_floats(self):
+        # a particle of python floats is tracked with numpy
+        vec = self.coords[:, 0]
+        p_in = track.Particle(*vec.tolist(), self.s, self.p0c, self.mc2)
+        lattice = self.lattice + [track.CrabCavity(L=0.2, VOLTAGE=1e5,
+                                                   PHI0=0.1,
+                                                   RF_FREQUENCY=1e9)]
+        p_out = track.track_a_lattice(p_in, lattice)
+        p_np = track.track_a_lattice(track.Particle(*vec, self.s, self.p0c,
+                                                    self.mc2), lattice)
+        assert np.allclose(np.array(p_out[:6]), np.array(p_np[:6]),
+                           atol=0, rtol=1.0e-15)
+        for p in (p_out, p_np, track.track_a_lattice(p_in, self.lattice)):
+            assert all(isinstance(c, np.float64) for c in p[:6])
+    
+    def test_numba(self):
+        # numba kernels agree with the pure python routines
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        make_track_f = {'Drift': track.make_track_a_drift,
+                        'Quadrupole': track.make_track_a_quadrupole}
+        for ele in self.lattice:
+            make_f = make_track_f[type(ele).__name__]
+            p_out = make_f(np)(p_in, ele)
+            x_np = np.vstack(p_out[:6])
+            x_torch = self.track_torch([ele])
+            assert np.allclose(x_np, x_torch, atol=1.0e-18, rtol=1.0e-13)
+            # unchanged coordinates are not copied, p_in is not modified
+            assert p_out.pz is p_in.pz
+            assert np.array_equal(np.vstack(p_in[:6]), self.coords)
+    
+    def test_compiled_lattice(self):
+        # compiled lattice agrees with the pure python routines
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        compiled = track.compile_lattice(self.lattice)
+        x_np = np.vstack(track.track_a_lattice(p_in, compiled)[:6])
+        x_torch = self.track_torch(self.lattice)
+        assert np.allclose(x_np, x_torch, atol=1.0e-18, rtol=1.0e-13)
+        
+        with pytest.raises(ValueError):
+            track.compile_lattice([track.CrabCavity(L=0.2, VOLTAGE=1e4,
+                                                    PHI0=0.5,
+                                                    RF_FREQUENCY=1e9)])
+    
+    def test_save(self):
+        # saved particles are the ones after the selected elements
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        all_p = track.track_a_lattice(p_in, self.lattice, save=True)
+        assert len(all_p) == len(self.lattice) + 1
+        assert all_p[0] is p_in
+        some_p = track.track_a_lattice(p_in, self.lattice, save=2)
+        assert [p.s for p in some_p] == [all_p[i].s for i in (0, 2, 4, 5)]
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        assert np.array_equal(np.vstack(p_out[:6]), np.vstack(some_p[-1][:6]))
+    
+    def test_particle_batch(self):
+        # a ParticleBatch is tracked in place
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        batch = track.ParticleBatch(*p_in)
+        x = batch.x
+        assert track.track_a_lattice(batch, self.lattice) is batch
+        assert batch.x is x
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        assert np.array_equal(np.vstack(batch.to_particle()[:6]),
+                              np.vstack(p_out[:6]))
+        assert batch.s == p_out.s
+        
+        # also through lattices that cannot be compiled
+        n = self.coords.shape[1]
+        lattice = [track.Quadrupole(L=0.1, K1=np.linspace(-5.0, 5.0, n)),
+                   track.CrabCavity(L=0.2, VOLTAGE=1e5, PHI0=0.1,
+                                    RF_FREQUENCY=1e9)] + self.lattice
+        batch = track.ParticleBatch(*p_in)
+        x = batch.x
+        all_p = track.track_a_lattice(batch, lattice, save=True)
+        assert batch.x is x
+        p_out = track.track_a_lattice(p_in, lattice)
+        assert np.array_equal(np.vstack(batch.to_particle()[:6]),
+                              np.vstack(p_out[:6]))
+        assert np.array_equal(np.vstack(all_p[-1][:6]), np.vstack(p_out[:6]))
+        assert batch.s == p_out.s
+        assert track.make_track_a_crab_cavity(np)(batch, lattice[1]) is batch
+        
+        # p0c and mc2 are shared by the whole beam
+        assert type(batch.p0c) is float and type(batch.mc2) is float
+        with pytest.raises(ValueError):
+            track.ParticleBatch(*p_in[:6], self.s, [self.p0c, 2*self.p0c],
+                                self.mc2)
+    
+    def test_stub_lattice(self):
+        # stubbing a compiled lattice equals compiling a stubbed lattice
+        stubbed = track.stub_lattice(self.lattice, 3)
+        assert len(stubbed) == 3 * len(self.lattice)
+        assert stubbed[:3] == [self.lattice[0]._replace(L=1.0/3)] * 3
+        compiled = track.stub_lattice(track.compile_lattice(self.lattice), 3)
+        expected = track.compile_lattice(stubbed)
+        assert np.array_equal(compiled.op_codes, expected.op_codes)
+        assert np.array_equal(compiled.params, expected.params)
+        
+        # runs of identical stubs are tracked as a single element
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        for lattice in (stubbed, compiled):
+            p_stub = track.track_a_lattice(p_in, lattice)
+            assert np.allclose(np.vstack(p_stub[:6]), np.vstack(p_out[:6]),
+                               atol=1.0e-16, rtol=1.0e-13)
+            assert np.isclose(p_stub.s, p_out.s, atol=0, rtol=1.0e-15)
+    
+    def test_float32(self):
+        # single precision beams agree to single precision
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        batch = track.ParticleBatch(*p_in, dtype=np.float32)
+        track.track_a_lattice(batch, self.lattice)
+        assert batch.x.dtype == np.float32
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        assert np.allclose(np.vstack(batch.to_particle()[:6]),
+                           np.vstack(p_out[:6]), atol=1.0e-9, rtol=1.0e-5)
+        
+        # float32 particles stay float32
+        p_32 = track.Particle(*self.coords.astype(np.float32), self.s,
+                              self.p0c, self.mc2)
+        for ele in self.lattice[:2]:
+            assert track.track_a_lattice(p_32, [ele]).x.dtype == np.float32
+        assert track.track_a_lattice(p_32, self.lattice).x.dtype == np.float32
+        p_drift = track.make_track_a_drift(np)(p_32, self.lattice[0])
+        p_quad = track.make_track_a_quadrupole(np)(p_32, self.lattice[1])
+        assert p_drift.x.dtype == p_quad.x.dtype == np.float32
+    
+    def test_array_parameters(self):
+        # elements with per-particle parameters broadcast over the beam
+        n = self.coords.shape[1]
+        lattice = [track.Drift(L=np.linspace(0.5, 1.5, n)),
+                   track.Quadrupole(L=0.1, K1=np.linspace(-5.0, 5.0, n),
+                                    X_OFFSET=1e-3, TILT=np.full(n, 0.3)),
+                   track.Drift(L=1.0)]
+        p_in = track.particle_from_coords(self.coords, self.s,
+                                          self.p0c, self.mc2)
+        p_out = track.track_a_lattice(p_in, lattice)
+        for i, vec in enumerate(self.coords.T):
+            lattice_i = [ele._replace(**{k: v[i] for k, v
+                                         in ele._asdict().items()
+                                         if np.ndim(v) != 0})
+                         for ele in lattice]
+            p_i = track.track_a_lattice(
+                track.Particle(*vec, self.s, self.p0c, self.mc2), lattice_i)
+            assert np.allclose(np.array(p_out[:6])[:, i], p_i[:6],
+                               atol=1.0e-18, rtol=1.0e-13)
+            assert np.isclose(p_out.s[i], p_i.s, atol=0, rtol=1.0e-15)
+        with pytest.raises(ValueError):
+            track.compile_lattice(lattice)
+        
+        # so do per-particle s
+        s_in = np.linspace(0.0, 1.0, n)
+        p_out = track.track_a_lattice(p_in._replace(s=s_in), self.lattice)
+        p_ref = track.track_a_lattice(p_in, self.lattice)
+        assert np.allclose(np.vstack(p_out[:6]), np.vstack(p_ref[:6]),
+                           atol=1.0e-18, rtol=1.0e-13)
+        assert np.allclose(p_out.s, s_in + p_ref.s, atol=0, rtol=1.0e-15)
+    
+    def test_blocks(self):
+        # beams of several blocks, the last one partial, are fully tracked
+        n = 2 * track.BLOCK_SIZE + 123
+        coords = np.random.default_rng(0).normal(scale=1e-3, size=(6, n))
+        p_in = track.particle_from_coords(coords, self.s, self.p0c,
+                                          self.mc2)
+        assert track._block_size(n) <= track.BLOCK_SIZE
+        p_out = track.track_a_lattice(p_in, self.lattice)
+        make_track_f = {'Drift': track.make_track_a_drift,
+                        'Quadrupole': track.make_track_a_quadrupole}
+        for ele in self.lattice:
+            coords = self.track_torch_ele(make_track_f[type(ele).__name__],
+                                          ele, coords)
+        assert np.allclose(np.vstack(p_out[:6]), coords,
+                           atol=1.0e-17, rtol=1.0e-13)
+    
+    def test_low_energy_z_correction(self):
+        # a beam mixing both regimes equals tracking them separately
+        f = track.make_f(np, 'low_energy_z_correction')
+        pz = np.array([1e-3, 0.5, -1e-4, 0.4, 2e-3])
+        p0c = np.full(pz.shape, 1e6)
+        dz = f(pz, p0c, self.mc2, 0.5)
+        dz_single = [f(np.array([v]), 1e6, self.mc2, 0.5)[0] for v in pz]
+        assert np.allclose(dz, dz_single, atol=0, rtol=1.0e-15)
+        dz_numba = [track._low_energy_z_correction(v, 1e6, self.mc2, 0.5)
+                    for v in pz]
+        assert np.allclose(dz, dz_numba, atol=0, rtol=1.0e-12)
+    
+    def test_quad_mat2_calc(self):
+        # both branches agree with the closed form transfer matrix
+        f = track.make_f(np, 'quad_mat2_calc')
+        length = 0.1
+        rel_p = 1.001
+        
+        def closed_form(k1):
+            sk = np.sqrt(np.abs(k1))
+            if k1 > 0:
+                return np.cosh(sk*length), np.sinh(sk*length) / sk
+            if k1 < 0:
+                return np.cos(sk*length), np.sin(sk*length) / sk
+            return 1.0, length
+        
+        # Taylor branch: |k1*length**2| < 1e-8
+        # mixed-sign branch: k1 of both signs (and zero) in the beam
+        for k1 in (np.array([1e-7, -5e-7, 0.0]),
+                   np.array([10.0, -5.0, 0.0, 1e-7, -3.0])):
+            a11, a12, a21, a22, c1, c2, c3 = f(k1, length, rel_p)
+            for i, k in enumerate(k1):
+                cx, sx = closed_form(k)
+                assert np.allclose([a11[i], a12[i], a21[i], a22[i]],
+                                   [cx, sx/rel_p, k*sx*rel_p, cx],
+                                   atol=0, rtol=1.0e-14)
+                assert np.allclose([c2[i], c3[i]],
+                                   [-k*sx*sx/(2*rel_p),
+                                    -(cx*sx + length)/(4*rel_p*rel_p)],
+                                   atol=0, rtol=1.0e-14)
+                # -cx*sx + length cancels for small k1
+                assert np.isclose(c1[i], k*(-cx*sx + length)/4,
+                                  atol=0, rtol=1.0e-6)
+                scalar = f(k, length, rel_p)
+                assert np.allclose([v[i] for v in (a11, a12, a21, a22,
+                                                   c1, c2, c3)],
+                                   scalar, atol=0, rtol=1.0e-15)
+    
+    def test_lost_particle(self):
+        # a lost particle gives NaN without stopping the rest of the beam
+        make_track_f = {'Drift': track.make_track_a_drift,
+                        'Quadrupole': track.make_track_a_quadrupole}
+        # |px| > 1 + pz in a drift, P = 0 in a quad
+        for ele, (i, v) in zip(self.lattice[:2], ((1, 1.5), (5, -1.0))):
+            coords = self.coords[:, :5].copy()
+            coords[i, 2] = v
+            p_in = track.particle_from_coords(coords, self.s, self.p0c,
+                                              self.mc2)
+            make_f = make_track_f[type(ele).__name__]
+            x_torch = self.track_torch_ele(make_f, ele, coords)
+            for p_out in (make_f(np)(p_in, ele),
+                          track.track_a_lattice(p_in, [ele])):
+                x_np = np.vstack(p_out[:6])
+                assert np.isfinite(np.delete(x_np, 2, axis=1)).all()
+                assert np.isnan(x_np[:, 2]).any()
+                assert np.allclose(x_np, x_torch, atol=1.0e-18,
+                                   rtol=1.0e-13, equal_nan=True)
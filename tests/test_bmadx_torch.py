@@ -311,10 +311,11 @@ class TestBmadxTorch:
         lattice = [d1, q1, d1, q1, d1]  # lattice is a list of elements
         # List of particle coordinates after each element:
         x_list = [torch.hstack(coords[:6]).detach()
-                  for coords in track.track_a_lattice(self.p_in, lattice)]
+                  for coords in track.track_a_lattice(self.p_in, lattice,
+                                                      save=True)]
         # Outgoing particle after complete lattice:
         x_py = torch.hstack(
-            track.track_a_lattice(self.p_in, lattice)[-1][:6]).detach()
+            track.track_a_lattice(self.p_in, lattice)[:6]).detach()
         # Bmad lattice to compare
         tao = Tao('-lat tests/bmad_lattices/test_drift_quad.bmad -noplot')
         set_tao(tao, self.pvec1)
@@ -326,7 +327,7 @@ class TestBmadxTorch:
         
         # test Taylor map
         f_driftquadrupole = lambda x: track.track_a_lattice(
-            track.Particle(*x,self.ts, self.tp0c, self.tmc2), lattice)[-1][:6]
+            track.Particle(*x,self.ts, self.tp0c, self.tmc2), lattice)[:6]
         
         J = jacobian(f_driftquadrupole, self.tvec1)
         mat_py = torch.vstack(J)
@@ -362,10 +363,44 @@ class TestBmadxTorch:
                 
                 lattice.append(drift)
 
-            p_out = track.track_a_lattice(p_in, lattice)[-1]
+            p_out = track.track_a_lattice(p_in, lattice)
             return torch.std(p_out.x)
         
         k1s = torch.zeros(5, **tkwargs)
         hessian_py = hessian(sigmax_end,k1s)
         isnan = torch.isnan(hessian_py)
-        assert torch.any(~isnan)
\ No newline at end of file
+        assert torch.any(~isnan)
+        
+        # compare with finite differences of sigmax_end (K1 = 0 is the
+        # Taylor branch of quad_mat2_calc, the steps are not)
+        h = 1.0e-3
+        steps = h * torch.eye(len(k1s), **tkwargs)
+        hessian_fd = torch.stack([torch.stack([
+            (sigmax_end(k1s + a + b) - sigmax_end(k1s + a - b)
+             - sigmax_end(k1s - a + b) + sigmax_end(k1s - a - b)) / (4*h*h)
+            for b in steps]) for a in steps])
+        assert torch.allclose(hessian_py, hessian_fd, atol=1.0e-10,
+                              rtol=1.0e-5)
+    
+    def test_quadrupole_scan_gradient(self):
+        # per-particle K1 through 0 has finite gradients that agree with
+        # finite differences (K1 = 0 takes the Taylor series)
+        L_q = torch.tensor(0.1, **tkwargs)
+        p_in = track.Particle(*self.tvec1.detach(), self.ts, self.tp0c,
+                              self.tmc2)
+        
+        def x_z_end(k1):
+            p_out = track_a_quadrupole_torch(p_in, torch_quadrupole(L=L_q,
+                                                                    K1=k1))
+            return p_out.x + p_out.z
+        
+        k1 = torch.arange(-50, 51, **tkwargs) / 10
+        assert torch.any(k1 == 0)
+        k1.requires_grad_(True)
+        grad_py = torch.autograd.grad(x_z_end(k1).sum(), k1)[0]
+        # particle i only depends on k1[i]
+        h = 1.0e-6
+        grad_fd = (x_z_end(k1.detach() + h)
+                   - x_z_end(k1.detach() - h)) / (2*h)
+        assert torch.all(torch.isfinite(grad_py))
+        assert torch.allclose(grad_py, grad_fd, atol=1.0e-12, rtol=1.0e-6)